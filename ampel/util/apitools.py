@@ -2,9 +2,17 @@
 # Author: Simeon Reusch (simeon.reusch@desy.de)
 # License: BSD-3-Clause
 
-import io, os, logging, time, json
+import io, os, logging, time, asyncio, gzip, tempfile
+from dataclasses import dataclass, field
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import backoff
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from appdirs import AppDirs
 import numpy as np
 import pandas as pd
@@ -12,7 +20,13 @@ from astropy.time import Time
 from tqdm import tqdm
 from ampel.ztf.t0.load.ZTFArchiveAlertLoader import ZTFArchiveAlertLoader
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 auth_token = os.environ["AMPEL_API_ARCHIVE_TOKEN_PASSWORD"]
+auth_header = {"Authorization": "bearer " + auth_token}
 endpoint_query = "https://ampel.zeuthen.desy.de/api/ztf/archive/v3/streams/from_query"
 endpoint_stream = "https://ampel.zeuthen.desy.de/api/ztf/archive/v3"
 filternames = {1: "g", 2: "r", 3: "i"}
@@ -20,12 +34,96 @@ filternames = {1: "g", 2: "r", 3: "i"}
 logger = logging.getLogger(__name__)
 
 
-class Stream(object):
+def _peak_mjds_numpy(fids, jds, mags):
+    """
+    MJD of the brightest detection in g, r and i (NaN if none). Detections
+    with NaN magpsf are skipped, as in _peak_mjds_loop
+    """
+    valid = ~np.isnan(mags)
+    peaks = np.full(3, np.nan)
+    for f in range(1, 4):
+        mask = valid & (fids == f)
+        if mask.any():
+            peaks[f - 1] = jds[mask][mags[mask].argmin()] - 2400000.5
+    return peaks
+
+
+def _peak_mjds_loop(fids, jds, mags):
+    """
+    MJD of the brightest detection in g, r and i (NaN if none), computed
+    in a single scan over the detections. NaN magpsf never compares as
+    brighter, so those detections are skipped
+    """
+    peaks = np.full(3, np.nan)
+    peak_mags = np.full(3, np.inf)
+    for i in range(fids.shape[0]):
+        f = fids[i] - 1
+        if 0 <= f < 3 and mags[i] < peak_mags[f]:
+            peak_mags[f] = mags[i]
+            peaks[f] = jds[i] - 2400000.5
+    return peaks
+
+
+if njit is not None:
+    peak_mjds = njit(cache=True)(_peak_mjds_loop)
+else:
+    peak_mjds = _peak_mjds_numpy
+
+
+def _merge_one_group(alerts: list) -> dict:
+    """
+    Merge all alerts of one objectId into a copy of the latest one. The
+    input alerts are left unchanged
+    """
+    if len(alerts) == 1:
+        return alerts[0]
+
+    jds = [x["candidate"]["jd"] for x in alerts]
+    order = sorted(range(len(jds)), key=jds.__getitem__, reverse=True)
+    latest = dict(alerts[order[0]])
+    latest["candidate"] = dict(
+        latest["candidate"],
+        jdstarthist=min(x["candidate"]["jdstarthist"] for x in alerts),
+    )
+
+    candidate = latest["candidate"]
+    seen = {(p["jd"], p["fid"], p.get("candid")) for p in latest["prv_candidates"]}
+    seen.add((candidate["jd"], candidate["fid"], candidate.get("candid")))
+    new_prv = []
+
+    for index in order[1:]:
+
+        x = alerts[index]
+
+        # Merge previous detections
+
+        for prv in x["prv_candidates"] + [x["candidate"]]:
+            k = (prv["jd"], prv["fid"], prv.get("candid"))
+            if k not in seen:
+                seen.add(k)
+                new_prv.append(prv)
+
+    # Previously merged detections were prepended one by one
+    latest["prv_candidates"] = new_prv[::-1] + latest["prv_candidates"]
+
+    return latest
+
+
+@dataclass(slots=True, eq=False, repr=False)
+class Stream:
     """Initiate and run stream query"""
 
-    def __init__(self):
-        super(Stream, self).__init__()
+    resume_token: str | None = None
+    resume_tokens: list | None = None
+    alert_list: list | None = None
+    merged_list: list | None = None
+    data: pd.DataFrame | None = None
+    cache_dir: str = field(default="", init=False)
+    _session: requests.Session | None = field(default=None, init=False)
+
+    def __post_init__(self):
         self.create_dir_for_token()
+        self.create_session()
 
     def create_dir_for_token(self):
         """
@@ -40,17 +138,41 @@ class Stream(object):
 
         return cache_dir
 
+    def create_session(self):
+        """
+        Create a pooled session that retries requests to the API while
+        it responds with 423 (Locked)
+        """
+        retry = Retry(
+            total=10,
+            backoff_factor=1.0,
+            status_forcelist=(423,),
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        session = requests.Session()
+        session.headers.update(auth_header)
+        session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=32))
+
+        self._session = session
+
+        return session
+
     def create_stream_from_objectIds(
         self,
         token: str = auth_token,
         objectIds: list = None,
-        candidate_dict: dict = {},
+        candidate_dict: dict | None = None,
     ) -> None:
         """
         Initiate a epoch based stream query
         """
         logger.debug(f"Creating a stream from objecIds: {objectIds}")
 
+        if candidate_dict is None:
+            candidate_dict = {}
+
         query = {
             "objectId": objectIds,
             "candidate": candidate_dict,
@@ -59,12 +181,74 @@ class Stream(object):
 
         self.generic_stream(query=query)
 
+    def create_streams_from_objectIds(
+        self,
+        objectId_batches: list,
+        candidate_dict: dict | None = None,
+        max_concurrent: int = 8,
+    ) -> list:
+        """
+        Initiate one objectId based stream query per batch of objectIds,
+        see create_streams_from_objectIds_async
+        """
+        return asyncio.run(
+            self.create_streams_from_objectIds_async(
+                objectId_batches=objectId_batches,
+                candidate_dict=candidate_dict,
+                max_concurrent=max_concurrent,
+            )
+        )
+
+    async def create_streams_from_objectIds_async(
+        self,
+        objectId_batches: list,
+        candidate_dict: dict | None = None,
+        max_concurrent: int = 8,
+    ) -> list:
+        """
+        Concurrently initiate one objectId based stream query per batch
+        """
+        logger.debug(f"Creating {len(objectId_batches)} streams from objectIds")
+
+        if candidate_dict is None:
+            candidate_dict = {}
+
+        semaphore = asyncio.Semaphore(max_concurrent)
+        transport = httpx.AsyncHTTPTransport(http2=True, retries=3)
+
+        async with httpx.AsyncClient(
+            transport=transport, headers=auth_header
+        ) as client:
+            results = await asyncio.gather(
+                *[
+                    self.generic_stream_async(
+                        client=client,
+                        query={"objectId": objectIds, "candidate": candidate_dict},
+                        semaphore=semaphore,
+                    )
+                    for objectIds in objectId_batches
+                ],
+                return_exceptions=True,
+            )
+
+        resume_tokens = [None if isinstance(r, Exception) else r for r in results]
+
+        self.resume_token = None
+        self.resume_tokens = resume_tokens
+        self._write_token_cache("resume_tokens.json", {"resume_tokens": resume_tokens})
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        return resume_tokens
+
     def create_stream_from_epoch(
         self,
         token: str = auth_token,
         date_start: str = "2014-10-10",
         date_end: str = "2022-06-28",
-        candidate_dict: dict = {},
+        candidate_dict: dict | None = None,
     ) -> str:
         """
         Initiate a epoch based stream query
@@ -72,10 +256,27 @@ class Stream(object):
         t_min_jd = Time(date_start).jd
         t_max_jd = Time(date_end).jd
 
-        logger.debug(
-            f"Generating query from {Time(t_min_jd, format='jd').iso} to {Time(t_max_jd, format='jd').iso}"
+        self.create_stream_from_jd(
+            t_min_jd=t_min_jd, t_max_jd=t_max_jd, candidate_dict=candidate_dict
         )
 
+    def create_stream_from_jd(
+        self,
+        t_min_jd: float,
+        t_max_jd: float,
+        candidate_dict: dict | None = None,
+    ) -> None:
+        """
+        Initiate a epoch based stream query with bounds given in JD
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Generating query from {Time(t_min_jd, format='jd').iso} to {Time(t_max_jd, format='jd').iso}"
+            )
+
+        if candidate_dict is None:
+            candidate_dict = {}
+
         query = {
             "jd": {
                 "$gt": t_min_jd,
@@ -90,89 +291,181 @@ class Stream(object):
 
     def generic_stream(self, query: dict):
 
-        header = {"Authorization": "bearer " + auth_token}
-
-        response = requests.post(url=endpoint_query, json=query, headers=header)
+        response = self._session.post(url=endpoint_query, json=query)
 
-        if not response.ok:
-            logger.warn(f"Accessing stream not successful. Response: {response.json()}")
-            raise ValueError(f"{response.json()['detail'][0]['msg']}")
-
-        else:
-            resume_token = response.json()["resume_token"]
+        resume_token = self._get_resume_token(
+            response.ok, orjson.loads(response.content)
+        )
 
         logger.info("Stream initiated.")
         logger.info(f"Your token: {resume_token}")
 
         self.resume_token = resume_token
 
-        with open(os.path.join(self.cache_dir, "resume_token.json"), "w") as outfile:
-            json.dump({"resume_token": resume_token}, outfile)
+        self._write_token_cache("resume_token.json", {"resume_token": resume_token})
+
+        return resume_token
+
+    def _write_token_cache(self, filename: str, content: dict) -> None:
+        """
+        Atomically write resume token(s) to the cache dir
+        """
+        token_path = os.path.join(self.cache_dir, filename)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(orjson.dumps(content))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_path, token_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
         logger.debug(f"Written resume token to {self.cache_dir}")
 
+    async def generic_stream_async(
+        self,
+        client: httpx.AsyncClient,
+        query: dict,
+        semaphore: asyncio.Semaphore,
+        max_retries: int = 10,
+    ):
+        """
+        Initiate a stream query with a shared async client, retrying on 423
+        """
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                response = await client.post(url=endpoint_query, json=query)
+                if response.status_code != 423 or attempt == max_retries:
+                    break
+                try:
+                    delay = float(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    delay = 2**attempt
+                logger.debug(f"API locked, retrying in {delay} s")
+                await asyncio.sleep(delay)
+
+        resume_token = self._get_resume_token(
+            response.is_success, orjson.loads(response.content)
+        )
+
+        logger.debug(f"Stream initiated. Token: {resume_token}")
+
         return resume_token
 
+    @staticmethod
+    def _get_resume_token(ok: bool, content: dict) -> str:
+        """
+        Extract the resume token from a stream query response
+        """
+        if not ok:
+            logger.warn(f"Accessing stream not successful. Response: {content}")
+            raise ValueError(f"{content['detail'][0]['msg']}")
+
+        return content["resume_token"]
+
+    def access_stream(
+        self, resume_token: str = None, n_workers: int = 4, use_cache: bool = True
+    ) -> list:
+        """
+        Access the stream for a given resume_token with n_workers loaders,
+        optionally caching the alerts in the cache dir
+        """
+        if not resume_token:
+            resume_token = self.resume_token
+
+        if not resume_token:
+            raise ValueError("No resume token given and no stream initiated yet")
+
+        cache_path = os.path.join(self.cache_dir, f"alerts_{resume_token}.ndjson.gz")
+
+        if use_cache and os.path.isfile(cache_path):
+            logger.debug(f"Reading alerts from {cache_path}")
+            alertlist = self._read_alert_cache(cache_path)
+            self.alert_list = alertlist
+            return alertlist
+
+        alertlist = []
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for alerts in executor.map(self._read_stream, [resume_token] * n_workers):
+                alertlist.extend(alerts)
+
+        if use_cache and alertlist:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as rawfile:
+                    with gzip.open(rawfile, "wb") as outfile:
+                        for alert in alertlist:
+                            outfile.write(orjson.dumps(alert))
+                            outfile.write(b"\n")
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            logger.debug(f"Written alerts to {cache_path}")
+
+        self.alert_list = alertlist
+
+        return alertlist
+
+    @staticmethod
+    def _read_stream(resume_token: str) -> list:
+        """
+        Drain chunks from the stream until it is exhausted
+        """
+        alerts = []
+        Stream._drain_stream(resume_token, alerts)
+        return alerts
+
+    @staticmethod
     @backoff.on_exception(
         backoff.expo,
         requests.HTTPError,
         giveup=lambda e: e.response.status_code not in {423},
         max_time=3600,
     )
-    def access_stream(self, resume_token: str = None) -> list:
+    def _drain_stream(resume_token: str, alerts: list) -> None:
         """
-        Access the stream for a given resume_token
+        Append alerts from the stream, keeping them across retries
         """
-        if not resume_token:
-            resume_token = self.resume_token
-
         alert_loader = ZTFArchiveAlertLoader(
             archive=endpoint_stream,
             stream=resume_token,
         )
-        alertlist = []
-        alerts = alert_loader.get_alerts()
-
-        for alert in alerts:
-            alertlist.append(alert)
-
-        self.alert_list = alertlist
+        for alert in alert_loader.get_alerts():
+            alerts.append(alert)
 
-        return alertlist
+    @staticmethod
+    def _read_alert_cache(path: str) -> list:
+        """
+        Read cached alerts from a gzipped ND-JSON file, one alert per line
+        """
+        with gzip.open(path, "rb") as infile:
+            return [orjson.loads(line) for line in infile]
 
-    def merge_alerts(self, alert_list: list = None) -> list:
+    def merge_alerts(self, alert_list: list = None, n_workers: int = 1) -> list:
         """
-        Generate one unified alert for each objectId
+        Generate one unified alert for each objectId, in a process pool if
+        n_workers > 1
         """
         if not alert_list:
             alert_list = self.alert_list
 
-        merged_list = []
-        keys = list(set([x["objectId"] for x in alert_list]))
-
-        for objectid in keys:
-            alerts = [x for x in alert_list if x["objectId"] == objectid]
-            if len(alerts) == 1:
-                merged_list.append(alerts[0])
-            else:
-                jds = [x["candidate"]["jd"] for x in alerts]
-                order = [jds.index(x) for x in sorted(jds)[::-1]]
-                latest = alerts[jds.index(max(jds))]
-                latest["candidate"]["jdstarthist"] = min(
-                    [x["candidate"]["jdstarthist"] for x in alerts]
-                )
-
-                for index in order[1:]:
+        # Merged alerts follow the order of first appearance in alert_list
+        groups = defaultdict(list)
+        for alert in alert_list:
+            groups[alert["objectId"]].append(alert)
 
-                    x = alerts[index]
-
-                    # Merge previous detections
-
-                    for prv in x["prv_candidates"] + [x["candidate"]]:
-                        if prv not in latest["prv_candidates"]:
-                            latest["prv_candidates"] = [prv] + latest["prv_candidates"]
+        if n_workers > 1 and len(groups) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                merged_list = list(
+                    executor.map(_merge_one_group, groups.values(), chunksize=64)
+                )
+        else:
+            merged_list = list(map(_merge_one_group, groups.values()))
 
-                merged_list.append(latest)
         self.merged_list = merged_list
         return merged_list
 
@@ -185,50 +478,42 @@ class Stream(object):
         if not merged_list:
             merged_list = self.merged_list
 
-        data = {}
-
-        for transient in merged_list:
-            _returndict = {}
-            objectId = transient["objectId"]
-            alert_content = transient["candidate"]
-            prv = transient["prv_candidates"]
-            prv.append(alert_content)
-            detections = []
-            for a in prv:
-                if "magpsf" in a.keys():
-                    detections.append(a)
+        key_list = tuple(key_list)
+        peak_names = {f: f"peak_mjd_{fname}" for f, fname in filternames.items()}
+        columns = list(key_list) + list(peak_names.values())
+        cols = {col: [] for col in columns}
+        index = []
+
+        for transient in sorted(merged_list, key=lambda t: t["objectId"]):
+            index.append(transient["objectId"])
+            source = chain(transient["prv_candidates"], (transient["candidate"],))
+            detections = [a for a in source if "magpsf" in a]
+            n_det = len(detections)
+
+            fids = np.fromiter(
+                (d["fid"] for d in detections), dtype=np.int8, count=n_det
+            )
+            jds = np.fromiter(
+                (d["jd"] for d in detections), dtype=np.float64, count=n_det
+            )
+            mags = np.fromiter(
+                (d["magpsf"] for d in detections), dtype=np.float64, count=n_det
+            )
 
             for key in key_list:
-                list_for_mean = []
-                for d in detections:
-                    if key in d.keys():
-                        list_for_mean.append(d[key])
-                if list_for_mean:
-                    _returndict.update({key: np.mean(list_for_mean)})
-                else:
-                    _returndict.update({key: None})
-
-            for f in range(1, 4):
-
-                magpsf = []
-                jd = []
-                for d in detections:
-                    if d["fid"] == f:
-                        magpsf.append(d["magpsf"])
-                        jd.append(d["jd"])
-                if len(magpsf) > 0:
-                    i = np.argmin(magpsf)
-                    _returndict.update(
-                        {f"peak_mjd_{filternames[f]}": jd[i] - 2400000.5}
-                    )
-                else:
-                    _returndict.update({f"peak_mjd_{filternames[f]}": None})
-
-            data.update({objectId: _returndict})
+                values = np.fromiter(
+                    (d[key] for d in detections if key in d), dtype=np.float64
+                )
+                cols[key].append(values.mean() if values.size else np.nan)
 
-        data = pd.DataFrame.from_dict(data, orient="index")
+            peaks = peak_mjds(fids, jds, mags)
+            for f, peak_name in peak_names.items():
+                cols[peak_name].append(peaks[f - 1])
 
-        data.sort_index(inplace=True)
+        data = pd.DataFrame(
+            {col: np.asarray(cols[col], dtype=np.float64) for col in columns},
+            index=index,
+        )
 
         self.data = data
         return data
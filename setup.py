@@ -13,6 +13,7 @@ setup(
     name="ampel-apitools",
     version="0.8.3",
     packages=find_namespace_packages(),
+    python_requires=">=3.10",
     package_data={
         "": ["*.json", "py.typed"],  # include any package containing *.json files
         "conf": [
@@ -32,8 +33,11 @@ setup(
         "astropy",
         "appdirs",
         "requests",
+        "httpx[http2]",
         "backoff",
         "numpy",
+        "numba",
         "pandas",
+        "orjson",
     ],
 )